@@ -1,10 +1,24 @@
 from fastmcp import FastMCP
+from fastmcp.server.lifespan import lifespan
 from fastmcp.server.providers import FileSystemProvider
 from pathlib import Path
 
+from shared.clients import close_openai_clients
+
+
+@lifespan
+async def clients_lifespan(server):
+    """服务退出时关闭共享的 OpenAI 客户端连接池"""
+    try:
+        yield {}
+    finally:
+        await close_openai_clients()
+
+
 mcp = FastMCP(
     name="PDF索引助手",
     instructions="PDF 文档索引服务，支持文本提取和内容摘要",
+    lifespan=clients_lifespan,
 )
 
 # v3: FileSystemProvider 自动发现 tools/ 下的工具
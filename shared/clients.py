@@ -0,0 +1,35 @@
+import httpx
+import openai
+
+# 按 (base_url, api_key) 复用的客户端；配置在进程内不变，实际只有 LLM 与 OCR 两组
+_clients: dict[tuple[str, str], openai.AsyncOpenAI] = {}
+
+
+def get_openai_client(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+    """获取共享的 OpenAI 兼容客户端，复用连接池以保持长连接"""
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            # 重试统一由 shared.retry.with_retry 负责，避免与 SDK 内置重试叠加，
+            # 同时让限流错误第一时间反馈给并发限制器
+            max_retries=0,
+            # 保留 SDK 默认的传输配置（如 follow_redirects），仅调整连接池与超时。
+            # 连接超时短以便快速重试；读取超时长，避免慢而有效的批量请求因超时被重复发送
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                timeout=httpx.Timeout(300, connect=10),
+            ),
+        )
+        _clients[key] = client
+    return client
+
+
+async def close_openai_clients():
+    """关闭所有已创建的客户端（服务退出时调用）"""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
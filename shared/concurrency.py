@@ -0,0 +1,108 @@
+from collections import deque
+from contextlib import asynccontextmanager
+import asyncio
+import functools
+import os
+import time
+
+
+class AdaptiveSemaphore:
+    """AIMD 自适应并发限制器
+
+    每次成功释放后记录耗时：窗口内平均耗时不超过 target_latency 时许可数加 alpha，
+    否则乘以 beta；遇到频率限制或服务端错误时由调用方通过 throttled() 强制乘性回退。
+    同一拥塞事件会让多个在途请求同时失败，因此乘性回退每个 RTT（实际耗时的滑动平均）
+    最多执行一次。max_permits 不低于初始许可数。
+    """
+
+    def __init__(
+        self,
+        permits: int = 8,
+        min_permits: int = 1,
+        max_permits: int = 32,
+        target_latency: float = 10.0,
+        alpha: int = 1,
+        beta: float = 0.5,
+        window: int = 20,
+    ):
+        self._min_permits = min_permits
+        self._permits = max(permits, min_permits)
+        self._max_permits = max(max_permits, self._permits)
+        self._inflight = 0
+        self._target_latency = target_latency
+        self._alpha = alpha
+        self._beta = beta
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._rtt = target_latency
+        self._last_decrease = float("-inf")
+        self._started: dict[asyncio.Task, float] = {}
+        self._cond = asyncio.Condition()
+
+    @property
+    def permits(self) -> int:
+        return self._permits
+
+    async def __aenter__(self):
+        await self._acquire()
+        self._started[asyncio.current_task()] = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        latency = time.monotonic() - self._started.pop(asyncio.current_task())
+        await self._release(latency if exc_type is None else None)
+        return False
+
+    @asynccontextmanager
+    async def slot(self, cost: float = 1.0):
+        """获取一个许可；cost 为本次调用包含的工作量（如批内页数），记录的耗时按 cost 归一化"""
+        await self._acquire()
+        start = time.monotonic()
+        try:
+            yield self
+        except BaseException:
+            await self._release(None)
+            raise
+        await self._release(time.monotonic() - start, cost)
+
+    async def _acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight < self._permits)
+            self._inflight += 1
+
+    async def _release(self, latency: float | None, cost: float = 1.0):
+        """释放许可；latency 为 None 表示调用失败，不参与调整"""
+        # 先同步完成计数，避免取消时许可泄漏
+        self._inflight -= 1
+        if latency is not None:
+            # RTT 取实际耗时的滑动平均（用于回退冷却），窗口记录按 cost 归一化的耗时
+            self._rtt = 0.8 * self._rtt + 0.2 * latency
+            self._latencies.append(latency / cost)
+            mean = sum(self._latencies) / len(self._latencies)
+            if mean <= self._target_latency:
+                self._permits = min(self._max_permits, self._permits + self._alpha)
+            else:
+                self._decrease()
+        async with self._cond:
+            self._cond.notify_all()
+
+    def throttled(self):
+        """服务端限流或出错时调用，触发乘性回退（每个 RTT 最多一次）"""
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self._rtt:
+            return
+        self._last_decrease = now
+        self._permits = max(self._min_permits, int(self._permits * self._beta))
+        # 清空窗口，回退后的调整只依据新的观测
+        self._latencies.clear()
+
+
+@functools.lru_cache(maxsize=1)
+def get_llm_limiter() -> AdaptiveSemaphore:
+    """获取进程内共享的 LLM/OCR 并发限制器 (首次调用时读取环境变量)"""
+    return AdaptiveSemaphore(
+        permits=int(os.getenv("PAGEINDEX_CONCURRENCY", "8")),
+        max_permits=int(os.getenv("PAGEINDEX_MAX_CONCURRENCY", "32")),
+    )
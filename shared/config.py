@@ -1,12 +1,14 @@
 from pathlib import Path
+import functools
 import os
 
 INDEX_DIR = Path.home() / ".pageindex"
 INDEX_DIR.mkdir(exist_ok=True)
 
 
+@functools.lru_cache(maxsize=1)
 def get_llm_config() -> tuple[str, str, str]:
-    """获取 LLM 配置 (动态读取环境变量)"""
+    """获取 LLM 配置 (首次调用时读取环境变量并缓存)"""
     return (
         os.getenv("PAGEINDEX_LLM_BASE_URL", ""),
         os.getenv("PAGEINDEX_LLM_API_KEY", ""),
@@ -14,8 +16,9 @@ def get_llm_config() -> tuple[str, str, str]:
     )
 
 
+@functools.lru_cache(maxsize=1)
 def get_ocr_config() -> tuple[str, str, str]:
-    """获取 OCR 配置 (动态读取环境变量)"""
+    """获取 OCR 配置 (首次调用时读取环境变量并缓存)"""
     return (
         os.getenv("PAGEINDEX_OCR_BASE_URL", ""),
         os.getenv("PAGEINDEX_OCR_API_KEY", ""),
@@ -23,12 +26,14 @@ def get_ocr_config() -> tuple[str, str, str]:
     )
 
 
+@functools.lru_cache(maxsize=1)
 def is_llm_configured() -> bool:
     """检查 LLM 是否配置"""
     base_url, api_key, _ = get_llm_config()
     return bool(base_url and api_key)
 
 
+@functools.lru_cache(maxsize=1)
 def is_ocr_configured() -> bool:
     """检查 OCR 是否配置"""
     base_url, api_key, model = get_ocr_config()
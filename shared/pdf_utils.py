@@ -1,143 +1,291 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 import fitz  # pymupdf
+import asyncio
+import functools
 import hashlib
 import json
 import base64
 import os
+import threading
 
-from shared.config import INDEX_DIR
+from shared.clients import get_openai_client
+from shared.config import INDEX_DIR, get_ocr_config, is_ocr_configured
+from shared.retry import with_retry
 
 
-def get_ocr_config():
-    return (
-        os.environ.get("PAGEINDEX_OCR_BASE_URL", ""),
-        os.environ.get("PAGEINDEX_OCR_API_KEY", ""),
-        os.environ.get("PAGEINDEX_OCR_MODEL", ""),
-    )
+# pymupdf 不是线程安全的：所有在工作线程中执行的 pymupdf 调用都需持有此锁
+_FITZ_LOCK = threading.Lock()
 
+# 纯文本提取只保留空白并裁剪到页面范围；不保留连字，输出普通字符便于总结
+_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
 
-def is_ocr_configured():
-    base_url, api_key, model = get_ocr_config()
-    return bool(base_url and api_key and model)
+# 已加载索引文件的内存缓存：文件路径 -> (修改时间 ns, 文件内容)
+_INDEX_CACHE: OrderedDict[str, tuple[int, object]] = OrderedDict()
+_INDEX_CACHE_SIZE = 128
 
+# 按文件签名缓存的函数结果（如 PDF 哈希），每个函数最多保留的文件数
+_FILE_CACHE_SIZE = 256
 
+# 上述缓存会在 asyncio.to_thread 的工作线程中读写，修改时需持有此锁
+_CACHE_LOCK = threading.Lock()
+
+
+def _mtime_lru_cache(func):
+    """按文件签名 (路径, 修改时间 ns, 大小) 缓存单参数函数的结果，文件变化后自动重新计算"""
+    cache: OrderedDict[str, tuple[tuple[int, int], object]] = OrderedDict()
+
+    @functools.wraps(func)
+    def wrapper(path: Path):
+        key = str(path)
+        st = path.stat()
+        signature = (st.st_mtime_ns, st.st_size)
+        with _CACHE_LOCK:
+            hit = cache.get(key)
+            if hit and hit[0] == signature:
+                cache.move_to_end(key)
+                return hit[1]
+
+        result = func(path)
+        with _CACHE_LOCK:
+            cache[key] = (signature, result)
+            cache.move_to_end(key)
+            while len(cache) > _FILE_CACHE_SIZE:
+                cache.popitem(last=False)
+        return result
+
+    return wrapper
+
+
+@_mtime_lru_cache
 def get_pdf_hash(pdf_path: Path) -> str:
-    """计算文件哈希"""
+    """计算文件哈希（分块流式读取，内存占用与文件大小无关）"""
     with open(pdf_path, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
 
+def get_file_stat(pdf_path: Path) -> list[int]:
+    """获取文件签名 [大小, 修改时间(ns)]，用于跳过未变化文件的哈希计算"""
+    st = pdf_path.stat()
+    return [st.st_size, st.st_mtime_ns]
 
-def get_index_path(pdf_path: Path) -> Path:
-    """获取索引文件路径"""
+
+def get_index_path(pdf_path: Path, kind: str = "meta") -> Path:
+    """获取索引文件路径
+
+    每个 PDF 的索引由三个文件组成：
+        meta: 元数据及各页摘要 ({stem}_{hash}.meta.json)
+        pages: 各页完整记录，每行一页 ({stem}_{hash}.pages.jsonl)
+        offsets: 页码 -> pages 文件中的 [偏移, 长度] ({stem}_{hash}.offsets.json)
+    """
     path_hash = hashlib.md5(str(pdf_path.absolute()).encode()).hexdigest()[:12]
-    return INDEX_DIR / f"{pdf_path.stem}_{path_hash}.json"
+    suffix = {"meta": "meta.json", "pages": "pages.jsonl", "offsets": "offsets.json"}[kind]
+    return INDEX_DIR / f"{pdf_path.stem}_{path_hash}.{suffix}"
 
 
-def get_total_pages(pdf_path: Path) -> int:
-    """获取 PDF 总页数"""
-    doc = None
+def open_pdf(pdf_path: Path) -> fitz.Document:
+    """打开 PDF 文档，调用方负责关闭"""
     try:
-        doc = fitz.open(pdf_path)
-        return len(doc)
+        with _FITZ_LOCK:
+            return fitz.open(pdf_path)
     except Exception as e:
         raise RuntimeError(f"无法打开 PDF: {pdf_path}, 错误: {e}")
-    finally:
-        if doc:
-            doc.close()
 
 
-async def ocr_page_image(pdf_path: Path, page_num: int) -> str:
+def close_pdf(doc: fitz.Document):
+    """关闭 PDF 文档（需持锁，在事件循环中应通过 asyncio.to_thread 调用）"""
+    with _FITZ_LOCK:
+        doc.close()
+
+
+def extract_all_pages_text(doc: fitz.Document) -> list[str | Exception]:
+    """单次遍历提取文档全部页面的文本，按页序返回
+
+    单页提取失败不影响其他页面：该页位置返回对应的异常对象，由调用方记录为失败页
+    """
+    out = []
+    with _FITZ_LOCK:
+        for page_num in range(len(doc)):
+            try:
+                out.append(doc[page_num].get_text("text", flags=_TEXT_FLAGS))
+            except Exception as e:
+                out.append(e)
+    return out
+
+
+def render_page_image(doc: fitz.Document, page_num: int) -> str:
+    """渲染某页为 base64 编码的灰度 JPEG（同步，供 asyncio.to_thread 调用，页码从 0 开始）"""
+    with _FITZ_LOCK:
+        if page_num < 0 or page_num >= len(doc):
+            raise ValueError(f"页码 {page_num} 超出范围 [0, {len(doc) - 1}]")
+        # 2x 缩放提高清晰度，JPEG 编码以减小上传体积
+        pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(2, 2), colorspace=fitz.csGRAY)
+        img_bytes = pix.tobytes("jpeg", jpg_quality=85)
+    return base64.b64encode(img_bytes).decode("utf-8")
+
+
+def needs_ocr(text: str) -> bool:
+    """pymupdf 提取的文本为空或过短，且 OCR 已配置时需要走 OCR"""
+    return len(text.strip()) < 10 and is_ocr_configured()
+
+
+async def ocr_page_image(doc: fitz.Document, page_num: int) -> str:
     """使用 OCR 提取 PDF 某页的文本内容（页码从 0 开始）
 
+    doc 为已打开的文档，由调用方负责关闭。页码检查、渲染和编码都在工作线程中持锁执行，
+    不阻塞事件循环；pymupdf 调用由全局锁串行化，因此并发 OCR 任务可以共享同一个 doc。
+
+    Returns:
+        提取的文本内容，OCR 失败时返回空字符串
+    """
+    img_base64 = await asyncio.to_thread(render_page_image, doc, page_num)
+    return await ocr_image(img_base64)
+
+
+async def ocr_image(img_base64: str) -> str:
+    """使用 OCR 提取已渲染页面图片（base64 编码的 JPEG）中的文本
+
     Returns:
         提取的文本内容，OCR 失败时返回空字符串
     """
     import openai
 
-    doc = None
     try:
-        doc = fitz.open(pdf_path)
-        if page_num < 0 or page_num >= len(doc):
-            raise ValueError(f"页码 {page_num} 超出范围 [0, {len(doc) - 1}]")
+        base_url, api_key, model = get_ocr_config()
+        client = get_openai_client(base_url, api_key)
+        response = await with_retry(
+            client.chat.completions.create,
+            model=model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{img_base64}"}
+                        },
+                        {
+                            "type": "text",
+                            "text": "请提取图片中的所有文字内容，保持原有格式和布局。只输出文字内容，不要添加任何解释。"
+                        }
+                    ]
+                }
+            ]
+        )
+        return response.choices[0].message.content or ""
+    except openai.APIConnectionError as e:
+        raise RuntimeError(f"OCR 服务连接失败: {e}") from e
+    except openai.RateLimitError as e:
+        raise RuntimeError(f"OCR 服务请求频率超限: {e}") from e
+    except openai.APIStatusError as e:
+        raise RuntimeError(f"OCR 服务返回错误 (状态码 {e.status_code}): {e.message}") from e
+    except Exception as e:
+        # 其他未知异常，返回空字符串并记录
+        return ""
 
-        page = doc[page_num]
-        # 渲染页面为图片 (2x 缩放提高清晰度)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img_bytes = pix.tobytes("png")
-        img_base64 = base64.b64encode(img_bytes).decode("utf-8")
-
-        try:
-            base_url, api_key, model = get_ocr_config()
-            client = openai.AsyncOpenAI(base_url=base_url, api_key=api_key)
-            response = await client.chat.completions.create(
-                model=model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:image/png;base64,{img_base64}"}
-                            },
-                            {
-                                "type": "text",
-                                "text": "请提取图片中的所有文字内容，保持原有格式和布局。只输出文字内容，不要添加任何解释。"
-                            }
-                        ]
-                    }
-                ]
-            )
-            return response.choices[0].message.content or ""
-        except openai.APIConnectionError as e:
-            raise RuntimeError(f"OCR 服务连接失败: {e}") from e
-        except openai.RateLimitError as e:
-            raise RuntimeError(f"OCR 服务请求频率超限: {e}") from e
-        except openai.APIStatusError as e:
-            raise RuntimeError(f"OCR 服务返回错误 (状态码 {e.status_code}): {e.message}") from e
-        except Exception as e:
-            # 其他未知异常，返回空字符串并记录
-            return ""
-    finally:
-        if doc:
-            doc.close()
+
+def load_index(pdf_path: Path) -> dict | None:
+    """加载索引元数据，pages 中仅包含页码、摘要（及错误信息），不含页面全文"""
+    return _load_json_cached(get_index_path(pdf_path))
 
 
-async def extract_page_text(pdf_path: Path, page_num: int) -> str:
-    """提取 PDF 某页的文本内容（页码从 0 开始）
+def load_page(pdf_path: Path, page: int) -> dict | None:
+    """按偏移表直接读取某一页的完整记录（页码从 1 开始），不存在时返回 None"""
+    offsets = _load_json_cached(get_index_path(pdf_path, "offsets"), _build_offset_index)
+    if not offsets or page not in offsets:
+        return None
+
+    offset, length = offsets[page]
+    with open(get_index_path(pdf_path, "pages"), "rb") as f:
+        f.seek(offset)
+        line = f.read(length)
 
-    如果 pymupdf 提取的文本为空或过短，且 OCR 已配置，则使用 OCR 提取
-    """
-    doc = None
     try:
-        doc = fitz.open(pdf_path)
-        if page_num < 0 or page_num >= len(doc):
-            raise ValueError(f"页码 {page_num} 超出范围 [0, {len(doc) - 1}]")
-        page = doc[page_num]
-        text = page.get_text()
+        record = json.loads(line)
+    except ValueError:
+        return None
+    # 偏移表与页面文件不一致（如正在重建）时视为未找到
+    return record if record.get("page") == page else None
 
-        # 如果文本为空或过短，尝试使用 OCR
-        if len(text.strip()) < 10 and is_ocr_configured():
-            doc.close()
-            doc = None
-            text = await ocr_page_image(pdf_path, page_num)
 
-        return text
-    finally:
-        if doc:
-            doc.close()
+def save_index(pdf_path: Path, index_data: dict):
+    """保存索引：先写页面文件和偏移表，最后写元数据"""
+    offsets = {}
+    position = 0
+    pages_path = get_index_path(pdf_path, "pages")
+    with _atomic_open(pages_path) as f:
+        for page_data in index_data["pages"]:
+            line = json.dumps(page_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets[str(page_data["page"])] = [position, len(line)]
+            position += len(line)
+    _save_json(get_index_path(pdf_path, "offsets"), offsets, _build_offset_index)
 
+    meta = {key: value for key, value in index_data.items() if key != "pages"}
+    meta["pages"] = [
+        {key: value for key, value in page_data.items() if key != "text"}
+        for page_data in index_data["pages"]
+    ]
+    save_index_meta(pdf_path, meta)
 
-def load_index(pdf_path: Path) -> dict | None:
-    """加载索引"""
-    index_path = get_index_path(pdf_path)
-    if index_path.exists():
-        with open(index_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return None
 
+def save_index_meta(pdf_path: Path, meta: dict):
+    """仅更新索引元数据（如刷新文件签名），页面文件保持不变"""
+    _save_json(get_index_path(pdf_path), meta)
 
-def save_index(pdf_path: Path, index_data: dict):
-    """保存索引"""
-    index_path = get_index_path(pdf_path)
-    with open(index_path, "w", encoding="utf-8") as f:
-        json.dump(index_data, f, ensure_ascii=False, indent=2)
+
+def _build_offset_index(offsets: dict) -> dict[int, tuple[int, int]]:
+    """将偏移表转换为以整数页码为键的哈希索引，加载时构建一次并随缓存复用"""
+    return {int(page): (offset, length) for page, (offset, length) in offsets.items()}
+
+
+def _load_json_cached(path: Path, build=None):
+    """读取 JSON 文件（按文件修改时间缓存在内存中），文件不存在时返回 None
+
+    build 用于在加载时把原始数据一次性转换为查询结构，缓存中保存转换后的结果
+    """
+    if not path.exists():
+        return None
+
+    key = str(path)
+    mtime = path.stat().st_mtime_ns
+    with _CACHE_LOCK:
+        hit = _INDEX_CACHE.get(key)
+        if hit and hit[0] == mtime:
+            _INDEX_CACHE.move_to_end(key)
+            return hit[1]
+
+    data = json.loads(path.read_bytes())
+    if build:
+        data = build(data)
+    _cache_index(key, mtime, data)
+    return data
+
+
+def _save_json(path: Path, data: dict, build=None):
+    """写入紧凑 JSON 文件并同步内存缓存（build 同 _load_json_cached）"""
+    with _atomic_open(path) as f:
+        f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    _cache_index(str(path), path.stat().st_mtime_ns, build(data) if build else data)
+
+
+@contextmanager
+def _atomic_open(path: Path):
+    """写入临时文件，成功后原子替换目标文件，避免崩溃时留下不完整的索引"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _cache_index(key: str, mtime: int, data):
+    """写入内存缓存，超出容量时淘汰最久未使用的条目"""
+    with _CACHE_LOCK:
+        _INDEX_CACHE[key] = (mtime, data)
+        _INDEX_CACHE.move_to_end(key)
+        while len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
@@ -0,0 +1,70 @@
+import asyncio
+import random
+
+import openai
+
+from shared.concurrency import get_llm_limiter
+
+MAX_ATTEMPTS = 6
+MIN_WAIT = 1.0
+MAX_WAIT = 60.0
+
+# 瞬时错误：频率超限、连接失败/超时（APITimeoutError 是 APIConnectionError 的子类）、服务端 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# 表示服务端过载的错误，触发共享并发限制器回退
+THROTTLE_ERRORS = (openai.RateLimitError, openai.InternalServerError)
+
+
+def _retry_after(e: Exception) -> float | None:
+    """解析响应头中的 Retry-After（秒），不存在或无法解析时返回 None"""
+    if not isinstance(e, openai.APIStatusError):
+        return None
+    value = e.response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _wait_seconds(attempt: int, e: Exception) -> float:
+    """计算第 attempt 次失败后的等待时间：优先 Retry-After，否则指数退避 + 随机抖动"""
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        return min(retry_after, MAX_WAIT)
+    return max(MIN_WAIT, random.uniform(0, min(MAX_WAIT, MIN_WAIT * 2**attempt)))
+
+
+async def with_retry(func, /, *args, **kwargs):
+    """调用异步函数，遇到瞬时错误时指数退避重试，超过 MAX_ATTEMPTS 次后抛出最后一次异常"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, THROTTLE_ERRORS):
+                get_llm_limiter().throttled()
+            if attempt == MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(_wait_seconds(attempt, e))
+
+
+async def with_sampling_retry(func, /, *args, **kwargs):
+    """调用 MCP Sampling，失败时按同样的退避策略重试
+
+    Sampling 由客户端代理调用 LLM，错误类型不统一，因此任何异常都视为瞬时错误，
+    并同样反馈给共享并发限制器。
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            get_llm_limiter().throttled()
+            if attempt == MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(_wait_seconds(attempt, e))
@@ -3,35 +3,50 @@ from fastmcp.tools import tool
 from pathlib import Path
 from datetime import datetime
 from asyncio import Lock
+import asyncio
+import itertools
 import json
-import sys
-
-from openai import AsyncOpenAI
-
-sys.path.insert(0, str(Path(__file__).parent.parent))
+import time
+import weakref
 
 from shared.pdf_utils import (
     get_pdf_hash,
-    extract_page_text,
+    get_file_stat,
+    extract_all_pages_text,
+    needs_ocr,
+    ocr_page_image,
+    open_pdf,
+    close_pdf,
     load_index,
     save_index,
-    get_total_pages,
+    save_index_meta,
 )
-import os
-# 动态读取环境变量
-def get_llm_config():
-    return (
-        os.environ.get("PAGEINDEX_LLM_BASE_URL", ""),
-        os.environ.get("PAGEINDEX_LLM_API_KEY", ""),
-        os.environ.get("PAGEINDEX_LLM_MODEL", "gpt-4o-mini"),
-    )
+from shared.clients import get_openai_client
+from shared.config import get_llm_config, is_llm_configured
+from shared.concurrency import AdaptiveSemaphore, get_llm_limiter
+from shared.retry import with_retry, with_sampling_retry
+
+# 并发锁：防止同一文件被重复索引。弱引用字典只保留正在使用中的锁，避免无限增长
+_indexing_locks: "weakref.WeakValueDictionary[str, Lock]" = weakref.WeakValueDictionary()
+_indexing_locks_guard = Lock()
+
 
-def is_llm_configured():
-    base_url, api_key, _ = get_llm_config()
-    return bool(base_url and api_key)
+async def _get_lock(key: str) -> Lock:
+    """获取或创建某个文件的索引锁，调用方需持有返回值直到使用结束"""
+    async with _indexing_locks_guard:
+        lock = _indexing_locks.get(key)
+        if lock is None:
+            lock = Lock()
+            _indexing_locks[key] = lock
+        return lock
 
-# 并发锁：防止同一文件被重复索引
-_indexing_locks: dict[str, Lock] = {}
+
+# 批量总结：每次 LLM 调用总结的页数，以及批内每页截断长度
+SUMMARY_BATCH_SIZE = 10
+BATCH_PAGE_CHARS = 1500
+
+# 进度上报的最小间隔（秒）
+PROGRESS_INTERVAL = 0.1
 
 
 async def call_llm(prompt: str, ctx: Context) -> str:
@@ -39,7 +54,12 @@ async def call_llm(prompt: str, ctx: Context) -> str:
     # 尝试使用 MCP Sampling
     if ctx:
         try:
-            response = await ctx.sample(prompt)
+            if is_llm_configured():
+                # 失败直接走下方 fallback（其自身带重试）
+                response = await ctx.sample(prompt)
+            else:
+                # Sampling 是唯一来源，瞬时失败需要重试，否则该页直接丢失
+                response = await with_sampling_retry(ctx.sample, prompt)
             return response.text.strip()
         except Exception as e:
             await ctx.debug(f"Sampling 失败: {e}")
@@ -49,8 +69,9 @@ async def call_llm(prompt: str, ctx: Context) -> str:
         raise RuntimeError("Sampling 不可用且 LLM 未配置")
 
     base_url, api_key, model = get_llm_config()
-    client = AsyncOpenAI(base_url=base_url, api_key=api_key)
-    response = await client.chat.completions.create(
+    client = get_openai_client(base_url, api_key)
+    response = await with_retry(
+        client.chat.completions.create,
         model=model,
         messages=[{"role": "user", "content": prompt}],
     )
@@ -76,6 +97,45 @@ async def summarize_text(text: str, page_num: int, ctx: Context) -> dict:
     return {"page": page_num, "text": text, "summary": summary}
 
 
+def _strip_code_fence(text: str) -> str:
+    """去掉 LLM 响应中常见的 ```json ... ``` 代码块包裹"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rstrip()
+        if text.endswith("```"):
+            text = text[:-3]
+    return text.strip()
+
+
+async def summarize_batch(pages: list[tuple[int, str]], ctx: Context) -> dict[int, str]:
+    """用一次 LLM 调用总结多页内容，返回 {页码: 摘要}；响应无法解析时返回空字典
+
+    Args:
+        pages: [(页码, 文本), ...]，页码从 1 开始，文本非空
+    """
+    sections = "\n\n".join(
+        f"=== 第{page_num}页 ===\n{text[:BATCH_PAGE_CHARS]}" for page_num, text in pages
+    )
+    prompt = f"""请为以下页面各用1-2句话总结，返回 JSON 数组 [{{"page": 页码, "summary": "摘要"}}]:
+
+{sections}
+
+仅返回JSON，不要其他内容。"""
+
+    response_text = await call_llm(prompt, ctx)
+    summaries: dict[int, str] = {}
+    try:
+        for item in json.loads(_strip_code_fence(response_text)):
+            summary = item.get("summary")
+            # 非字符串（null、数字等）或空摘要视为缺失，由调用方逐页回退
+            if isinstance(summary, str) and summary.strip():
+                summaries[int(item["page"])] = summary.strip()
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return {}
+    return summaries
+
+
 async def search_with_llm(
     query: str, pages: list[dict], ctx: Context, top_k: int = 5
 ) -> list[dict]:
@@ -110,11 +170,20 @@ async def search_with_llm(
 
 async def _build_index(pdf_path: Path, ctx: Context) -> dict:
     """内部函数：构建索引"""
-    current_hash = get_pdf_hash(pdf_path)
+    file_stat = get_file_stat(pdf_path)
+
+    # 检查缓存：文件大小和修改时间未变时直接命中，无需读取文件计算哈希
+    cached = await asyncio.to_thread(load_index, pdf_path)
+    if cached and cached.get("stat") == file_stat:
+        if ctx:
+            await ctx.info(f"使用缓存索引: {pdf_path.name}")
+        return cached
 
-    # 检查缓存
-    cached = load_index(pdf_path)
+    current_hash = await asyncio.to_thread(get_pdf_hash, pdf_path)
     if cached and cached.get("file_hash") == current_hash:
+        # 内容未变（仅修改时间变化），刷新签名以便下次走快速路径
+        cached["stat"] = file_stat
+        await asyncio.to_thread(save_index_meta, pdf_path, cached)
         if ctx:
             await ctx.info(f"使用缓存索引: {pdf_path.name}")
         return cached
@@ -123,42 +192,142 @@ async def _build_index(pdf_path: Path, ctx: Context) -> dict:
     if ctx:
         await ctx.info(f"开始索引 {pdf_path.name}...")
 
-    total_pages = get_total_pages(pdf_path)
-    pages_data = []
-
-    for page_num in range(total_pages):
-        if ctx:
-            await ctx.report_progress(progress=page_num, total=total_pages)
+    # 整个构建过程只打开一次文档，所有页面共享同一个句柄
+    doc = await asyncio.to_thread(open_pdf, pdf_path)
+    # 进程内共享的自适应限制器：多个文件同时索引时整体回退
+    sem = get_llm_limiter()
+    done = 0
+    last_report = 0.0
+
+    async def _advance(steps: int):
+        """推进进度（OCR 页与总结页各计一步）；距上次上报不足间隔时跳过，结束后统一上报最终进度"""
+        nonlocal done, last_report
+        done += steps
+        now = time.monotonic()
+        if ctx and now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            await ctx.report_progress(progress=done, total=total_steps)
+
+    async def _ocr_page(page_num: int, sem: AdaptiveSemaphore) -> str:
+        """OCR 单页（页码从 0 开始），受限制器约束并发"""
+        try:
+            async with sem:
+                return await ocr_page_image(doc, page_num)
+        finally:
+            await _advance(1)
 
+    async def _summarize_page(page: int, text: str, sem: AdaptiveSemaphore) -> str | Exception:
+        """单页总结（批量结果缺失时的回退），失败时返回异常对象，只影响该页"""
         try:
-            page_text = await extract_page_text(pdf_path, page_num)
-            page_result = await summarize_text(page_text, page_num + 1, ctx)
-            pages_data.append(page_result)
+            if not text.strip():
+                return (await summarize_text(text, page, ctx))["summary"]
+            async with sem:
+                return (await summarize_text(text, page, ctx))["summary"]
         except Exception as e:
-            if ctx:
-                await ctx.warning(f"第 {page_num + 1} 页处理失败: {e}")
-            pages_data.append(
-                {
-                    "page": page_num + 1,
-                    "error": str(e),
-                    "text": "",
-                    "summary": "处理失败",
-                }
+            return e
+
+    async def _summarize_batch(
+        batch: tuple[tuple[int, str], ...], sem: AdaptiveSemaphore
+    ) -> list[str | Exception]:
+        """总结一批页面：批量调用按页数归一化计时，未得到摘要的页面逐页回退"""
+        try:
+            to_batch = [(page, text) for page, text in batch if text.strip()]
+            batch_summaries: dict[int, str | Exception] = {}
+            if to_batch:
+                try:
+                    async with sem.slot(cost=len(to_batch)):
+                        batch_summaries = await summarize_batch(to_batch, ctx)
+                except Exception as e:
+                    if ctx:
+                        await ctx.debug(f"批量总结失败，逐页重试: {e}")
+
+            missing = [(page, text) for page, text in batch if page not in batch_summaries]
+            fallbacks = await asyncio.gather(
+                *[_summarize_page(page, text, sem) for page, text in missing]
             )
+            batch_summaries.update((page, result) for (page, _), result in zip(missing, fallbacks))
+            return [batch_summaries[page] for page, _ in batch]
+        finally:
+            await _advance(len(batch))
+
+    # 第一阶段：提取文本，文本过短的页面并发 OCR
+    page_errors: dict[int, BaseException] = {}
+    try:
+        page_texts = await asyncio.to_thread(extract_all_pages_text, doc)
+        total_pages = len(page_texts)
+        for page_num, text in enumerate(page_texts):
+            if isinstance(text, Exception):
+                page_errors[page_num] = text
+                page_texts[page_num] = ""
+        ocr_pages = [
+            i for i, text in enumerate(page_texts) if i not in page_errors and needs_ocr(text)
+        ]
+        total_steps = total_pages + len(ocr_pages)
+        ocr_results = await asyncio.gather(
+            *[_ocr_page(i, sem) for i in ocr_pages], return_exceptions=True
+        )
+    finally:
+        await asyncio.to_thread(close_pdf, doc)
+
+    for page_num, result in zip(ocr_pages, ocr_results):
+        if isinstance(result, BaseException):
+            page_errors[page_num] = result
+        else:
+            page_texts[page_num] = result
+
+    # 第二阶段：分批并发总结
+    pending = [(i + 1, text) for i, text in enumerate(page_texts) if i not in page_errors]
+    # 提取或 OCR 失败、不再总结的页面直接计入进度
+    await _advance(total_pages - len(pending))
+    batches = list(itertools.batched(pending, SUMMARY_BATCH_SIZE))
+    batch_results = await asyncio.gather(
+        *[_summarize_batch(batch, sem) for batch in batches], return_exceptions=True
+    )
+
+    # 文本与摘要分别按页序保存在列表中，最后统一组装页面记录
+    summaries: list[str] = [""] * total_pages
+    for batch, result in zip(batches, batch_results):
+        if isinstance(result, BaseException):
+            for page, _ in batch:
+                page_errors[page - 1] = result
+        else:
+            for (page, _), summary in zip(batch, result):
+                if isinstance(summary, Exception):
+                    page_errors[page - 1] = summary
+                else:
+                    summaries[page - 1] = summary
+
+    pages_data = []
+    for page_num, (text, summary) in enumerate(zip(page_texts, summaries)):
+        error = page_errors.get(page_num)
+        if error is None:
+            pages_data.append({"page": page_num + 1, "text": text, "summary": summary})
+            continue
+        if ctx:
+            await ctx.warning(f"第 {page_num + 1} 页处理失败: {error}")
+        pages_data.append(
+            {
+                "page": page_num + 1,
+                "error": str(error),
+                "text": "",
+                "summary": "处理失败",
+            }
+        )
 
     if ctx:
-        await ctx.report_progress(progress=total_pages, total=total_pages)
+        await ctx.report_progress(progress=total_steps, total=total_steps)
 
     # 保存索引
     index_data = {
         "file_path": str(pdf_path),
         "file_hash": current_hash,
+        "stat": file_stat,
         "total_pages": total_pages,
         "indexed_at": datetime.now().isoformat(),
         "pages": pages_data,
     }
 
-    save_index(pdf_path, index_data)
+    await asyncio.to_thread(save_index, pdf_path, index_data)
     if ctx:
         await ctx.info(f"索引完成: {pdf_path.name}, 共 {total_pages} 页")
     return index_data
@@ -187,13 +356,9 @@ async def get_index(
     if not pdf_path.suffix.lower() == ".pdf":
         return {"error": f"不是 PDF 文件: {file_path}"}
 
-    # 获取或创建锁
-    path_key = str(pdf_path)
-    if path_key not in _indexing_locks:
-        _indexing_locks[path_key] = Lock()
-
     # 使用锁防止并发索引同一文件
-    async with _indexing_locks[path_key]:
+    lock = await _get_lock(str(pdf_path))
+    async with lock:
         index_data = await _build_index(pdf_path, ctx)
 
     # 如果有查询，执行 LLM 语义搜索